@@ -1,18 +1,33 @@
 import time
 import glob
-import json
+from array import array
+import io
 import os
+import struct
+import zlib
+import numpy as np
 import torch
 import psycopg2
-import psycopg2.extras
 from pgvector.psycopg2 import register_vector
-from transformers import AutoTokenizer, AutoModel, DataCollatorWithPadding
+from transformers import AutoTokenizer, AutoModel
 from tqdm import tqdm
 import logging
 from collections import defaultdict
 from dotenv import load_dotenv
 import sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from multiprocessing import shared_memory
+from xxhash import xxh3_64_intdigest
+
+try:
+    # orjson parses straight from bytes and is several times faster than json
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # --- Load Environment Variables ---
 try:
@@ -31,16 +46,74 @@ except Exception as e:
     sys.exit(1)
 
 # --- Configuration ---
+def env_flag(name, default):
+    """Reads a boolean environment variable ("1", "true" or "yes" enable it)."""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.lower() in ("1", "true", "yes")
+
 MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+MODEL_ONNX_REPO = "LightEmbed/sbert-all-MiniLM-L6-v2-onnx"
 ANALYSES_DIR_PATTERN = "../analyses/partition=*/*.jsonl"
 DB_TABLE_NAME = "document_chunk_embeddings"
+STAGING_TABLE_NAME = "staging_chunk_embeddings"
 CHUNK_BATCH_SIZE = 1000
 DB_BATCH_SIZE = 50000
 MAX_SEQ_LENGTH = 512
 CHUNK_OVERLAP = 50
 SAFETY_BUFFER = 15
 MAX_CPU_WORKERS = os.cpu_count()
+# "process" runs file workers (JSON parsing, text extraction, tokenization) in
+# separate processes so the GIL-bound parts scale across cores too.
+FILE_WORKER_MODE = os.getenv("FILE_WORKER_MODE", "thread").lower()
 ETA_UPDATE_INTERVAL_SEC = 10
+OUTPUT_BUFFER_COUNT = 2
+CHUNK_QUEUE_SIZE = CHUNK_BATCH_SIZE * 8
+QUEUE_PUT_TIMEOUT_SEC = 1
+# Each writer runs its own COPY stream on its own connection.
+DB_WRITER_COUNT = 4
+DB_QUEUE_SIZE = DB_WRITER_COUNT * 2
+FILE_READ_BLOCK_SIZE = 4 * 1024 * 1024
+LENGTH_BUCKET_WIDTH = 64
+TOKENIZE_BATCH_SIZE = 512
+# "upsert" stages each batch and merges it with ON CONFLICT (safe for re-runs);
+# "overwrite" merges the same way but also rewrites rows whose hash is unchanged;
+# "insert" stages the same way but never touches existing rows (ON CONFLICT DO NOTHING);
+# "copy" streams straight into the table and is fastest for a first, empty load.
+INSERT_MODE = os.getenv("INSERT_MODE", "upsert").lower()
+# "onnx" runs the exported model on ONNX Runtime (TensorRT/CUDA/CPU provider)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+# Dynamic INT8 quantization of the ONNX model's MatMul weights; mainly a CPU win
+ONNX_QUANTIZE_INT8 = env_flag("ONNX_QUANTIZE_INT8", False)
+# Dynamic INT8 quantization of the PyTorch model's Linear layers when running on CPU
+TORCH_CPU_QUANTIZE_INT8 = env_flag("TORCH_CPU_QUANTIZE_INT8", True)
+ONNX_CACHE_DIR = "onnx_cache"
+# "halfvec" stores FP16 vectors (pgvector >= 0.7), halving table, index and COPY size.
+EMBEDDING_DB_TYPE = os.getenv("EMBEDDING_DB_TYPE", "vector").lower()
+# L2-normalize on the GPU, matching sentence-transformers' output for cosine search.
+NORMALIZE_EMBEDDINGS = env_flag("NORMALIZE_EMBEDDINGS", True)
+# Compile the PyTorch model (with pooling); batches are then padded to multiples of
+# LENGTH_BUCKET_WIDTH so only a handful of shapes are ever specialized.
+TORCH_COMPILE = env_flag("TORCH_COMPILE", False)
+# "inductor" (PyTorch's own) or "tensorrt" (Torch-TensorRT engines per shape, built
+# in the model's BF16/FP16 precision)
+TORCH_COMPILE_BACKEND = os.getenv("TORCH_COMPILE_BACKEND", "inductor").lower()
+# Inductor only: "reduce-overhead" additionally captures a CUDA graph per shape,
+# replacing the per-batch kernel launches with a single replay.
+TORCH_COMPILE_MODE = os.getenv("TORCH_COMPILE_MODE", "default").lower()
+# Probe the largest CHUNK_BATCH_SIZE that fits on the GPU at full sequence length.
+AUTO_BATCH_SIZE = env_flag("AUTO_BATCH_SIZE", True)
+AUTO_BATCH_SIZE_CANDIDATES = (1024, 2048, 4096, 8192, 16384)
+# Skip documents whose text hash matches the one stored with their embeddings.
+SKIP_UNCHANGED = env_flag("SKIP_UNCHANGED", True)
+# synchronous_commit=off on the writer session: a server crash can lose the last few
+# commits, which a re-run regenerates, in exchange for not waiting on WAL flushes.
+DB_ASYNC_COMMIT = env_flag("DB_ASYNC_COMMIT", True)
+
+# Each worker thread (or process) tokenizes its own file; Rust-side parallelism
+# on top of that only oversubscribes the cores.
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -53,6 +126,48 @@ PRIVATE_DB_URL = os.getenv("PRIVATE_DB_URL")
 if not PRIVATE_DB_URL:
     logging.error("Database URL not configured (PRIVATE_DB_URL). Exiting.")
     sys.exit(1)
+if INSERT_MODE not in ("upsert", "overwrite", "insert", "copy"):
+    logging.error(
+        f"Unknown INSERT_MODE '{INSERT_MODE}'. Expected 'upsert', 'overwrite', 'insert' or 'copy'. Exiting."
+    )
+    sys.exit(1)
+if EMBEDDING_BACKEND not in ("torch", "onnx"):
+    logging.error(f"Unknown EMBEDDING_BACKEND '{EMBEDDING_BACKEND}'. Expected 'torch' or 'onnx'. Exiting.")
+    sys.exit(1)
+if FILE_WORKER_MODE not in ("thread", "process"):
+    logging.error(f"Unknown FILE_WORKER_MODE '{FILE_WORKER_MODE}'. Expected 'thread' or 'process'. Exiting.")
+    sys.exit(1)
+if TORCH_COMPILE_MODE not in ("default", "reduce-overhead", "max-autotune"):
+    logging.error(
+        f"Unknown TORCH_COMPILE_MODE '{TORCH_COMPILE_MODE}'. Expected 'default', 'reduce-overhead' or 'max-autotune'. Exiting."
+    )
+    sys.exit(1)
+if TORCH_COMPILE_BACKEND not in ("inductor", "tensorrt"):
+    logging.error(f"Unknown TORCH_COMPILE_BACKEND '{TORCH_COMPILE_BACKEND}'. Expected 'inductor' or 'tensorrt'. Exiting.")
+    sys.exit(1)
+USE_CUDA_GRAPHS = (
+    TORCH_COMPILE and TORCH_COMPILE_BACKEND == "inductor" and TORCH_COMPILE_MODE == "reduce-overhead"
+)
+if EMBEDDING_DB_TYPE not in ("vector", "halfvec"):
+    logging.error(f"Unknown EMBEDDING_DB_TYPE '{EMBEDDING_DB_TYPE}'. Expected 'vector' or 'halfvec'. Exiting.")
+    sys.exit(1)
+
+# --- Binary COPY Format ---
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+PGCOPY_TRAILER = struct.pack(">h", -1)
+# Big-endian element type of each pgvector type's binary representation
+VECTOR_ELEMENT_DTYPES = {"vector": ">f4", "halfvec": ">f2"}
+
+# Chunks travel the queue as (url, chunk_id, token_ids, content_hash, chunk_count, token_hash).
+# Markers are plain strings (compared with ==) so they survive pickling when file
+# workers run in separate processes.
+# Marks the end of a file on the chunk queue: (FILE_DONE, filepath, None, None, None, None)
+FILE_DONE = "__file_done__"
+# Reports bytes consumed from a file on the chunk queue: (BYTES_READ, filepath, nbytes, None, None, None)
+BYTES_READ = "__bytes_read__"
+# The worker pool broke (initializer failure, killed process) while a file was
+# pending: (FILE_FAILED, filepath, None, None, None, None)
+FILE_FAILED = "__file_failed__"
 
 # --- Helper Functions ---
 def connect_db():
@@ -77,150 +192,885 @@ def create_table_if_not_exists(conn, embedding_dim):
             CREATE TABLE IF NOT EXISTS {DB_TABLE_NAME} (
                 url TEXT NOT NULL,
                 chunk_id INTEGER NOT NULL,
-                embedding VECTOR({embedding_dim}),
+                embedding {EMBEDDING_DB_TYPE}({embedding_dim}),
+                content_hash BIGINT,
+                chunk_count INTEGER,
                 PRIMARY KEY (url, chunk_id)
             );
             """
         )
+        # Tables created before content hashes or chunk counts existed; their rows
+        # stay NULL, and so count as incomplete, until re-embedded.
+        cur.execute(f"ALTER TABLE {DB_TABLE_NAME} ADD COLUMN IF NOT EXISTS content_hash BIGINT;")
+        cur.execute(f"ALTER TABLE {DB_TABLE_NAME} ADD COLUMN IF NOT EXISTS chunk_count INTEGER;")
         conn.commit()
         logging.info(
-            f"Ensured table '{DB_TABLE_NAME}' exists with vector dimension {embedding_dim}."
+            f"Ensured table '{DB_TABLE_NAME}' exists with {EMBEDDING_DB_TYPE} dimension {embedding_dim}."
         )
 
+def fetch_content_hashes(conn):
+    """Returns a ContentHashIndex of every document whose embeddings are complete.
+
+    Chunks of one document are spread over several batches and writers, any of which
+    can fail or be lost, so a document only counts once all of its rows agree on one
+    hash and one chunk count and chunk ids 0..chunk_count-1 are all present. Anything
+    less is re-embedded.
+    """
+    # A full-table GROUP BY can outlast connect_db's timeout on a large table;
+    # SET LOCAL lifts it for this transaction only.
+    with conn.cursor() as cur:
+        cur.execute("SET LOCAL statement_timeout = 0;")
+    with conn.cursor(name="content_hashes") as cur:
+        cur.itersize = 100000
+        # (url, chunk_id) is unique, so count(*) = chunk_count together with
+        # max(chunk_id) = chunk_count - 1 means no id is missing.
+        cur.execute(
+            f"""
+            SELECT
+                url,
+                min(content_hash),
+                count(content_hash) = count(*)
+                    AND count(DISTINCT content_hash) = 1
+                    AND count(chunk_count) = count(*)
+                    AND min(chunk_count) = max(chunk_count)
+                    AND count(*) = min(chunk_count)
+                    AND max(chunk_id) = min(chunk_count) - 1
+            FROM {DB_TABLE_NAME}
+            GROUP BY url;
+            """
+        )
+        url_keys, content_hashes = [], []
+        incomplete_docs = 0
+        for url, content_hash, complete in cur:
+            if complete:
+                url_keys.append(compute_url_key(url))
+                content_hashes.append(content_hash)
+            else:
+                incomplete_docs += 1
+    conn.commit()
+    if incomplete_docs:
+        # Left by an interrupted run or a failed batch, or written before chunk counts were stored.
+        logging.info(f"Found {incomplete_docs} incompletely stored documents; they will be embedded again.")
+    return ContentHashIndex.create(
+        np.array(url_keys, dtype=np.uint64), np.array(content_hashes, dtype=np.int64)
+    )
+
+def compute_url_key(url):
+    """Hashes a URL to the unsigned 64-bit key ContentHashIndex looks it up by."""
+    return xxh3_64_intdigest(url.encode("utf-8"))
+
+class ContentHashIndex:
+    """Sorted (URL key, content hash) arrays in shared memory, one copy for all file workers.
+
+    Pickles as just the segment's name, so process-mode workers attach to the parent's
+    copy instead of each receiving the whole table. A URL key collision also needs a
+    matching content hash to skip a document, which 64-bit keys make negligible.
+    """
+
+    def __init__(self, name, count):
+        self._shm = shared_memory.SharedMemory(name=name)
+        self._count = count
+        self.url_keys = np.ndarray((count,), dtype=np.uint64, buffer=self._shm.buf)
+        self.content_hashes = np.ndarray((count,), dtype=np.int64, buffer=self._shm.buf, offset=count * 8)
+
+    @classmethod
+    def create(cls, url_keys, content_hashes):
+        """Sorts the arrays by URL key into a new shared memory segment owned by the caller."""
+        order = np.argsort(url_keys)
+        count = len(order)
+        # Zero-sized segments are not allowed.
+        shm = shared_memory.SharedMemory(create=True, size=max(1, count * 16))
+        np.ndarray((count,), dtype=np.uint64, buffer=shm.buf)[:] = url_keys[order]
+        np.ndarray((count,), dtype=np.int64, buffer=shm.buf, offset=count * 8)[:] = content_hashes[order]
+        index = cls(shm.name, count)
+        shm.close()
+        return index
+
+    def __reduce__(self):
+        return ContentHashIndex, (self._shm.name, self._count)
+
+    def __len__(self):
+        return self._count
+
+    def get(self, url):
+        """Returns the stored content hash of a URL, or None."""
+        key = np.uint64(compute_url_key(url))
+        position = int(np.searchsorted(self.url_keys, key))
+        if position < self._count and self.url_keys[position] == key:
+            return int(self.content_hashes[position])
+        return None
+
+    def release(self, unlink=False):
+        """Detaches from the segment; the creating process also unlinks it."""
+        self.url_keys = self.content_hashes = None
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+
+def compute_content_hash_seed(model_precision):
+    """Seeds content hashes with every setting besides the text that shapes its embeddings.
+
+    model_precision names the backend, its quantization and the GPU dtype, so changing
+    any of them (or the chunking) re-embeds documents instead of keeping old vectors.
+    """
+    settings = (
+        f"{MODEL_NAME}|{MAX_SEQ_LENGTH}|{SAFETY_BUFFER}|{CHUNK_OVERLAP}|"
+        f"{NORMALIZE_EMBEDDINGS}|{model_precision}"
+    )
+    return zlib.crc32(settings.encode("utf-8"))
+
+def compute_content_hash(text, seed):
+    """Hashes a document's text (and the embedding settings) to a signed 64-bit int for BIGINT storage."""
+    digest = xxh3_64_intdigest(text.encode("utf-8"), seed=seed)
+    return digest - (1 << 64) if digest >= (1 << 63) else digest
+
+def create_staging_table(conn):
+    """Creates the per-connection temp table that binary COPY batches land in."""
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE_NAME}
+            (LIKE {DB_TABLE_NAME} INCLUDING DEFAULTS)
+            ON COMMIT DELETE ROWS;
+            """
+        )
+    conn.commit()
+
+def build_copy_buffer(rows, embeddings):
+    """Packs (url, chunk_id, content_hash, chunk_count) rows and an [N, dim] embedding array into a binary COPY payload."""
+    num_rows, dim = embeddings.shape
+    # pgvector binary format: uint16 dim, uint16 unused, big-endian float32/float16[dim]
+    element_dtype = np.dtype(VECTOR_ELEMENT_DTYPES[EMBEDDING_DB_TYPE])
+    vector_bytes = element_dtype.itemsize * dim
+    slab = memoryview(np.ascontiguousarray(embeddings, dtype=element_dtype).tobytes())
+    url_bytes = [url.encode("utf-8") for url, _, _, _ in rows]
+    # Field count + url length, then chunk_id, content_hash and chunk_count (length,
+    # value each) and the vector field header.
+    row_header = struct.Struct(">hi")
+    row_middle = struct.Struct(">iiiqiiiHH")
+
+    # Size the payload up front and pack each row in place instead of growing a stream.
+    total_size = (
+        len(PGCOPY_HEADER)
+        + num_rows * (row_header.size + row_middle.size + vector_bytes)
+        + sum(map(len, url_bytes))
+        + len(PGCOPY_TRAILER)
+    )
+    buf = bytearray(total_size)
+    buf[: len(PGCOPY_HEADER)] = PGCOPY_HEADER
+    offset = len(PGCOPY_HEADER)
+    for i, ((_, chunk_id, content_hash, chunk_count), url) in enumerate(zip(rows, url_bytes)):
+        row_header.pack_into(buf, offset, 5, len(url))
+        offset += row_header.size
+        buf[offset : offset + len(url)] = url
+        offset += len(url)
+        row_middle.pack_into(
+            buf, offset, 4, chunk_id, 8, content_hash, 4, chunk_count, 4 + vector_bytes, dim, 0
+        )
+        offset += row_middle.size
+        buf[offset : offset + vector_bytes] = slab[i * vector_bytes : (i + 1) * vector_bytes]
+        offset += vector_bytes
+    buf[offset:] = PGCOPY_TRAILER
+    return io.BytesIO(buf)
+
+def insert_embeddings(conn, rows, embeddings):
+    """Bulk loads a batch via binary COPY, either directly or through the staging table."""
+    if not rows:
+        return 0
+    try:
+        with conn.cursor() as cur:
+            if INSERT_MODE == "copy":
+                cur.copy_expert(
+                    f"COPY {DB_TABLE_NAME} (url, chunk_id, content_hash, chunk_count, embedding) FROM STDIN WITH (FORMAT BINARY)",
+                    build_copy_buffer(rows, embeddings),
+                )
+            else:
+                cur.copy_expert(
+                    f"COPY {STAGING_TABLE_NAME} (url, chunk_id, content_hash, chunk_count, embedding) FROM STDIN WITH (FORMAT BINARY)",
+                    build_copy_buffer(rows, embeddings),
+                )
+                if INSERT_MODE == "insert":
+                    on_conflict = "DO NOTHING"
+                elif INSERT_MODE == "overwrite":
+                    # For changes the content hash can't see, e.g. new weights under
+                    # the same model name: every staged row replaces the stored one.
+                    on_conflict = """DO UPDATE
+                    SET embedding = EXCLUDED.embedding,
+                        content_hash = EXCLUDED.content_hash,
+                        chunk_count = EXCLUDED.chunk_count"""
+                else:
+                    # Rows with the same content hash already hold these embeddings;
+                    # rewriting them would only churn the heap, the index and the WAL.
+                    on_conflict = f"""DO UPDATE
+                    SET embedding = EXCLUDED.embedding,
+                        content_hash = EXCLUDED.content_hash,
+                        chunk_count = EXCLUDED.chunk_count
+                    WHERE ({DB_TABLE_NAME}.content_hash, {DB_TABLE_NAME}.chunk_count)
+                        IS DISTINCT FROM (EXCLUDED.content_hash, EXCLUDED.chunk_count)"""
+                cur.execute(
+                    f"""
+                    INSERT INTO {DB_TABLE_NAME} (url, chunk_id, content_hash, chunk_count, embedding)
+                    SELECT url, chunk_id, content_hash, chunk_count, embedding FROM {STAGING_TABLE_NAME}
+                    ON CONFLICT (url, chunk_id) {on_conflict};
+                    """
+                )
+                if INSERT_MODE in ("upsert", "overwrite"):
+                    # A document that got shorter leaves its old tail behind; drop it
+                    # along with the batch that carries the new chunk 0.
+                    cur.execute(
+                        f"""
+                        DELETE FROM {DB_TABLE_NAME} AS t
+                        USING {STAGING_TABLE_NAME} AS s
+                        WHERE s.chunk_id = 0 AND t.url = s.url AND t.chunk_id >= s.chunk_count;
+                        """
+                    )
+        conn.commit()
+        return len(rows)
+    except psycopg2.Error as db_err:
+        logging.error(f"Database batch insert failed: {db_err}")
+        conn.rollback()
+        return 0
+    except Exception as general_db_err:
+        logging.error(f"Unexpected error during DB insert: {general_db_err}", exc_info=True)
+        conn.rollback()
+        return 0
+
+def connect_writer_db():
+    """Opens the writer thread's own connection, tuned for a pure-insert workload."""
+    conn = connect_db()
+    conn.set_session(isolation_level="READ COMMITTED", autocommit=False)
+    if DB_ASYNC_COMMIT:
+        with conn.cursor() as cur:
+            cur.execute("SET synchronous_commit = off;")
+        conn.commit()
+    if INSERT_MODE != "copy":
+        # Temp tables are per session, so the staging table lives on this connection.
+        create_staging_table(conn)
+    return conn
+
+def db_writer(conn, db_queue, inserted_counts):
+    """Writes (rows, embeddings) batches from the queue until it receives None, then closes conn."""
+    try:
+        while True:
+            batch = db_queue.get()
+            if batch is None:
+                return
+            rows, embeddings = batch
+            inserted_counts.append(insert_embeddings(conn, rows, embeddings))
+    finally:
+        conn.close()
+
 def extract_relevant_text(entry):
     """Extracts and combines relevant text fields from a JSON entry."""
     title = entry.get("title", "") or ""
     content = entry.get("content_text", "") or ""
+    meta_tags = entry.get("meta_tags")
     description = ""
-    if "meta_tags" in entry and isinstance(entry["meta_tags"], list):
-        for tag in entry["meta_tags"]:
-            if (
-                isinstance(tag, dict)
+    # orjson/json only ever produce exact dicts and lists, so a type() identity
+    # check is enough and cheaper than isinstance on this per-document path.
+    if meta_tags and type(meta_tags) is list:
+        description = next(
+            (
+                tag["content"]
+                for tag in meta_tags
+                if type(tag) is dict
                 and tag.get("name") == "description"
                 and tag.get("content")
-            ):
-                description = tag["content"]
-                break
-    combined_text = f"Title: {title}\nDescription: {description}\nContent: {content}".strip()
+            ),
+            "",
+        )
+    # Only label fields that are present; empty prefixes would still cost tokens.
+    parts = []
+    if title:
+        parts.append(f"Title: {title}")
+    if description:
+        parts.append(f"Description: {description}")
+    if content:
+        parts.append(f"Content: {content}")
+    if not parts:
+        return ""
+    combined_text = "\n".join(parts).strip()
     return combined_text
 
-def chunk_text_yield_token_ids(text, tokenizer, max_tokens, overlap):
-    """Chunks text and yields lists of token IDs with length validation."""
-    if not text:
-        return
+def compute_chunk_window(tokenizer, max_tokens, overlap):
+    """Returns (effective_max_tokens, stride) for chunking, or None if nothing fits.
 
+    These only depend on the tokenizer and configuration, so they are computed
+    once at startup rather than for every document.
+    """
     num_special_tokens = tokenizer.num_special_tokens_to_add(pair=False)
-    effective_max_tokens = max(1, max_tokens - num_special_tokens - SAFETY_BUFFER)
+    if (max_tokens - num_special_tokens) <= 0:
+        return None
 
+    effective_max_tokens = max(1, max_tokens - num_special_tokens - SAFETY_BUFFER)
     if effective_max_tokens <= overlap:
         overlap = max(0, effective_max_tokens // 4)
 
-    if (max_tokens - num_special_tokens) <= 0:
-        return
+    stride = effective_max_tokens - overlap
+    if stride <= 0:
+        stride = max(1, effective_max_tokens // 2)
+    return effective_max_tokens, stride
+
+def tokenize_and_chunk_documents(urls, texts, hashes, tokenizer, chunk_window):
+    """Tokenizes a batch of documents in one call and yields (url, chunk_id, List[int], content_hash, chunk_count, token_hash) tuples.
 
+    chunk_id is the window's position within its document, so re-running a file
+    always produces the same keys; chunk_count is the document's number of windows.
+    token_hash is a 64-bit hash of the token IDs, which the consumer dedups on.
+    """
+    effective_max_tokens, stride = chunk_window
     try:
-        tokens = tokenizer.encode(
-            text,
+        # One call per batch lets the Rust tokenizer do both the encoding and the
+        # overlapping windows without crossing back into Python for every document.
+        encoded = tokenizer(
+            texts,
             add_special_tokens=False,
-            truncation=False
+            truncation=True,
+            max_length=effective_max_tokens,
+            stride=effective_max_tokens - stride,
+            return_overflowing_tokens=True,
+            return_attention_mask=False,
+            return_token_type_ids=False,
         )
     except Exception as e:
-        logging.error(f"Failed to tokenize text (length {len(text)}): {e}")
+        logging.error(f"Failed to tokenize batch of {len(texts)} documents: {e}")
         return
 
-    if len(tokens) <= effective_max_tokens:
-        if len(tokens) > max_tokens:
-            logging.warning(f"Single chunk ({len(tokens)} tokens) exceeds max_tokens ({max_tokens}). Truncating.")
-            yield tokens[:max_tokens]
-        else:
-            logging.debug(f"Input fits in one chunk ({len(tokens)} tokens).")
-            yield tokens
-        return
+    # Windows come back flattened, in document order; the mapping says whose they are.
+    doc_indices = encoded["overflow_to_sample_mapping"]
+    chunk_counts = [0] * len(texts)
+    for doc_index in doc_indices:
+        chunk_counts[doc_index] += 1
+    previous_doc_index = -1
+    chunk_id = 0
+    for token_ids, doc_index in zip(encoded["input_ids"], doc_indices):
+        chunk_id = chunk_id + 1 if doc_index == previous_doc_index else 0
+        previous_doc_index = doc_index
+        # Hashed here, on the worker, so the single consumer never hashes token lists.
+        token_hash = xxh3_64_intdigest(array("i", token_ids).tobytes())
+        yield (urls[doc_index], chunk_id, token_ids, hashes[doc_index], chunk_counts[doc_index], token_hash)
 
-    stride = effective_max_tokens - overlap
-    if stride <= 0:
-        stride = max(1, effective_max_tokens // 2)
-
-    current_pos = 0
-    chunk_count = 0
-    while current_pos < len(tokens):
-        chunk_tokens = tokens[current_pos : current_pos + effective_max_tokens]
-        if not chunk_tokens:
-            break
-
-        if len(chunk_tokens) > effective_max_tokens:
-            logging.error(f"Chunk slice yielded {len(chunk_tokens)} tokens, exceeding effective_max_tokens {effective_max_tokens}. Truncating.")
-            chunk_tokens = chunk_tokens[:effective_max_tokens]
-
-        logging.debug(f"Yielding chunk {chunk_count} with {len(chunk_tokens)} tokens (effective_max={effective_max_tokens}).")
-        yield chunk_tokens
-        chunk_count += 1
-
-        next_pos = current_pos + stride
-        if next_pos <= current_pos:
-            logging.error(f"Chunking loop stalled at position {current_pos}. Breaking.")
+def iter_jsonl_lines(f):
+    """Yields the lines of a binary file, reading it in large blocks."""
+    remainder = b""
+    while True:
+        block = f.read(FILE_READ_BLOCK_SIZE)
+        if not block:
             break
-        current_pos = next_pos
+        lines = (remainder + block).split(b"\n")
+        remainder = lines.pop()
+        yield from lines
+    if remainder:
+        yield remainder
 
-    logging.debug(f"Finished yielding {chunk_count} token ID chunks")
+def process_file_yield_token_ids_fs(filepath, tokenizer, chunk_window, content_hash_seed, existing_hashes):
+    """Worker function yielding (url, chunk_id, List[int], content_hash, chunk_count, token_hash) tuples.
 
-def process_file_yield_token_ids_fs(filepath, tokenizer, max_tokens, overlap):
-    """Worker function yielding (url, chunk_id, List[int]) tuples."""
-    chunk_counts = defaultdict(int)
+    Documents whose content hash matches `existing_hashes` are skipped. Interleaves
+    (BYTES_READ, filepath, nbytes, None, None, None) markers after each tokenized batch so
+    progress can be tracked by bytes read instead of a separate counting pass.
+    """
+    # Chunk ids restart at 0 per document, so a URL repeated within the file would
+    # collide with its own earlier rows; the first occurrence wins.
+    seen_urls = set()
+    batch_urls, batch_texts, batch_hashes = [], [], []
+    bytes_reported = 0
+    bad_lines = 0
+    unchanged_docs = 0
+    duplicate_docs = 0
     try:
-        with open(filepath, "r", encoding="utf-8") as f:
-            for line_num, line in enumerate(f, 1):
+        with open(filepath, "rb") as f:
+            for line in iter_jsonl_lines(f):
+                if not line:
+                    continue
+                # Every record is a JSON object; anything else is noise.
+                if line[0] != 0x7B:  # b"{"
+                    bad_lines += 1
+                    continue
+                # orjson reports invalid UTF-8 as a JSONDecodeError; the stdlib
+                # fallback raises UnicodeDecodeError. Both are ValueErrors.
+                try:
+                    entry = json_loads(line)
+                except ValueError:
+                    bad_lines += 1
+                    continue
+
+                # A malformed record (a non-string url, a lone surrogate that cannot
+                # be encoded for hashing) only costs that record, not the file.
                 try:
-                    entry = json.loads(line)
                     url = entry.get("url")
                     if not url:
                         continue
+                    if type(url) is not str:
+                        # Would otherwise fail the whole COPY batch it lands in.
+                        bad_lines += 1
+                        continue
+                    if url in seen_urls:
+                        duplicate_docs += 1
+                        continue
+                    seen_urls.add(url)
 
                     text = extract_relevant_text(entry)
                     if not text:
                         continue
 
-                    start_chunk_id = chunk_counts[url]
-                    chunk_index = 0
-                    for token_ids in chunk_text_yield_token_ids(
-                        text, tokenizer, max_tokens, overlap
-                    ):
-                        yield (url, start_chunk_id + chunk_index, token_ids)
-                        chunk_index += 1
-                    chunk_counts[url] += chunk_index
-
-                except json.JSONDecodeError:
-                    logging.warning(f"Invalid JSON on line {line_num} in {filepath}")
-                except Exception as e:
-                    logging.warning(f"Error on line {line_num} in {filepath}: {e}")
+                    content_hash = compute_content_hash(text, content_hash_seed)
+                except Exception:
+                    bad_lines += 1
+                    continue
+                if existing_hashes.get(url) == content_hash:
+                    unchanged_docs += 1
+                    continue
+
+                batch_urls.append(url)
+                batch_texts.append(text)
+                batch_hashes.append(content_hash)
+                if len(batch_texts) >= TOKENIZE_BATCH_SIZE:
+                    yield from tokenize_and_chunk_documents(
+                        batch_urls, batch_texts, batch_hashes, tokenizer, chunk_window
+                    )
+                    batch_urls, batch_texts, batch_hashes = [], [], []
+                    bytes_read = f.tell()
+                    yield (BYTES_READ, filepath, bytes_read - bytes_reported, None, None, None)
+                    bytes_reported = bytes_read
+
+            if batch_texts:
+                yield from tokenize_and_chunk_documents(
+                    batch_urls, batch_texts, batch_hashes, tokenizer, chunk_window
+                )
+            yield (BYTES_READ, filepath, f.tell() - bytes_reported, None, None, None)
     except Exception as e:
-        logging.error(f"Failed to process file {filepath}: {e}")
+        logging.error(f"Failed to process file {filepath}: {e}", exc_info=True)
+    finally:
+        if bad_lines:
+            logging.warning(f"Skipped {bad_lines} invalid JSONL lines or records in {filepath}")
+        if unchanged_docs:
+            logging.debug(f"Skipped {unchanged_docs} unchanged documents in {filepath}")
+        if duplicate_docs:
+            logging.warning(
+                f"Skipped {duplicate_docs} repeated occurrences of URLs in {filepath}; only the first is embedded"
+            )
+
+def put_until_stopped(chunk_queue, item, stop_event):
+    """Puts an item on a bounded queue, giving up once the consumer has stopped."""
+    while not stop_event.is_set():
+        try:
+            chunk_queue.put(item, timeout=QUEUE_PUT_TIMEOUT_SEC)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def produce_file_token_ids(
+    filepath, tokenizer, chunk_window, content_hash_seed, existing_hashes, chunk_queue, stop_event
+):
+    """Worker that runs a file's chunk generator on the pool thread and feeds the queue.
+
+    FILE_DONE is only sent on success; if this raises, report_file_worker_failure
+    sends the file's end marker instead, so each file is counted exactly once.
+    """
+    for item in process_file_yield_token_ids_fs(
+        filepath, tokenizer, chunk_window, content_hash_seed, existing_hashes
+    ):
+        if not put_until_stopped(chunk_queue, item, stop_event):
+            return
+    put_until_stopped(chunk_queue, (FILE_DONE, filepath, None, None, None, None), stop_event)
+
+def report_file_worker_failure(filepath, chunk_queue, stop_event, future):
+    """Done callback that ends a file whose worker raised instead of sending FILE_DONE.
+
+    Without it the consumer would wait forever for that file's marker. A broken pool
+    (failed initializer, killed worker process) is reported as FILE_FAILED so the run
+    stops; any other error just ends the file.
+    """
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is None:
+        return
+    logging.error(f"File worker failed on {filepath}: {error}", exc_info=error)
+    marker = FILE_FAILED if isinstance(error, BrokenExecutor) else FILE_DONE
+    put_until_stopped(chunk_queue, (marker, filepath, None, None, None, None), stop_event)
 
-def encode_batch_token_ids(model, tokenizer, batch_data, device, max_seq_len):
-    """Encodes a batch of token ID lists with forced truncation."""
+# Per-process state of a file worker started by init_file_worker
+_file_worker_state = {}
+
+def init_file_worker(chunk_window, content_hash_seed, existing_hashes, chunk_queue, stop_event):
+    """ProcessPoolExecutor initializer: loads this process's own tokenizer once.
+
+    existing_hashes arrives as a ContentHashIndex attached to the parent's shared memory.
+    """
+    _file_worker_state["tokenizer"] = AutoTokenizer.from_pretrained(MODEL_NAME, use_fast=True)
+    _file_worker_state["chunk_window"] = chunk_window
+    _file_worker_state["content_hash_seed"] = content_hash_seed
+    _file_worker_state["existing_hashes"] = existing_hashes
+    _file_worker_state["chunk_queue"] = chunk_queue
+    _file_worker_state["stop_event"] = stop_event
+    # Don't block process exit on flushing the queue: by the time the pool shuts
+    # down normally every item has been consumed, and after an abort nobody reads them.
+    chunk_queue.cancel_join_thread()
+
+def produce_file_token_ids_in_process(filepath):
+    """Process-pool entry point for produce_file_token_ids."""
+    produce_file_token_ids(
+        filepath,
+        _file_worker_state["tokenizer"],
+        _file_worker_state["chunk_window"],
+        _file_worker_state["content_hash_seed"],
+        _file_worker_state["existing_hashes"],
+        _file_worker_state["chunk_queue"],
+        _file_worker_state["stop_event"],
+    )
+
+# Per-thread tokenizer of a file worker started by init_thread_tokenizer
+_thread_tokenizer = threading.local()
+
+def init_thread_tokenizer():
+    """ThreadPoolExecutor initializer: gives each worker thread its own tokenizer.
+
+    A single fast tokenizer shared by every thread serializes them on its internal
+    lock, so thread mode shards it the same way process mode does.
+    """
+    _thread_tokenizer.tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, use_fast=True)
+
+def file_worker_ready():
+    """No-op task whose result shows a pool worker (and its initializer) started."""
+    return True
+
+def produce_file_token_ids_in_thread(
+    filepath, chunk_window, content_hash_seed, existing_hashes, chunk_queue, stop_event
+):
+    """Thread-pool entry point for produce_file_token_ids."""
+    produce_file_token_ids(
+        filepath,
+        _thread_tokenizer.tokenizer,
+        chunk_window,
+        content_hash_seed,
+        existing_hashes,
+        chunk_queue,
+        stop_event,
+    )
+
+def expand_duplicate_chunks(batch_data, duplicates, embeddings):
+    """Returns the database rows of an encoded batch, duplicates included, and their embeddings.
+
+    Each entry of `duplicates` is (index into batch_data, row) for a chunk whose token
+    IDs matched that batch entry, so it reuses the entry's embedding.
+    """
+    rows = [
+        (url, chunk_id, content_hash, chunk_count)
+        for url, chunk_id, _, content_hash, chunk_count in batch_data
+    ]
+    if not duplicates:
+        return rows, embeddings
+    rows.extend(row for _, row in duplicates)
+    embeddings = np.concatenate([embeddings, embeddings[[index for index, _ in duplicates]]])
+    return rows, embeddings
+
+def iter_length_bucketed_batches(chunk_queue, total_files, batch_size, max_seq_len):
+    """Groups queued chunks into model batches of similar token length.
+
+    Yields (FILE_DONE, filepath) as each file completes, (FILE_FAILED, filepath) if the
+    worker pool breaks, (BYTES_READ, (filepath, nbytes)) as workers report progress,
+    and (None, (batch, duplicates)) whenever a length bucket fills up, so batches are
+    padded to roughly their own length rather than the longest chunk that happened to
+    arrive. Leftovers are flushed shortest bucket first once all files are done.
+
+    Chunks with identical token IDs (shared titles, boilerplate) landing in the same
+    bucket are only encoded once; see expand_duplicate_chunks. Duplicates are kept as
+    bare rows but still count toward batch_size, so a bucket never holds more than
+    batch_size chunks.
+    """
+    # bucket key -> (chunks to encode, {token hash: index into chunks}, duplicate rows)
+    buckets = {}
+    files_done = 0
+    while files_done < total_files:
+        url, chunk_id, token_ids, content_hash, chunk_count, token_hash = chunk_queue.get()
+        if url == FILE_DONE:
+            files_done += 1
+            yield FILE_DONE, chunk_id
+            continue
+        if url == FILE_FAILED:
+            files_done += 1
+            yield FILE_FAILED, chunk_id
+            continue
+        if url == BYTES_READ:
+            yield BYTES_READ, (chunk_id, token_ids)
+            continue
+
+        if len(token_ids) > max_seq_len * 1.1:
+            logging.warning(f"Received abnormally long token list ({len(token_ids)} tokens) from chunker for {url} chunk {chunk_id}. Skipping.")
+            continue
+
+        bucket_key = len(token_ids) // LENGTH_BUCKET_WIDTH
+        bucket = buckets.get(bucket_key)
+        if bucket is None:
+            bucket = buckets[bucket_key] = ([], {}, [])
+        chunks, first_index, duplicates = bucket
+        index = first_index.get(token_hash)
+        # Comparing the token lists turns a (64-bit) hash collision into a miss
+        # instead of a wrong embedding.
+        if index is not None and chunks[index][2] == token_ids:
+            duplicates.append((index, (url, chunk_id, content_hash, chunk_count)))
+        else:
+            first_index.setdefault(token_hash, len(chunks))
+            chunks.append((url, chunk_id, token_ids, content_hash, chunk_count))
+        if len(chunks) + len(duplicates) >= batch_size:
+            del buckets[bucket_key]
+            yield None, (chunks, duplicates)
+
+    # Every partial bucket is smaller than batch_size; merge neighbours into full batches.
+    batch, duplicates = [], []
+    for bucket_key in sorted(buckets):
+        bucket_chunks, _, bucket_duplicates = buckets[bucket_key]
+        if batch and len(batch) + len(bucket_chunks) > batch_size:
+            yield None, (batch, duplicates)
+            batch, duplicates = [], []
+        duplicates.extend((len(batch) + index, row) for index, row in bucket_duplicates)
+        batch.extend(bucket_chunks)
+    if batch:
+        yield None, (batch, duplicates)
+
+def allocate_output_buffers(count, batch_size, embedding_dim, dtype=torch.float32):
+    """Allocates pinned host buffers that GPU embeddings are copied into asynchronously."""
+    return [
+        torch.empty((batch_size, embedding_dim), dtype=dtype, pin_memory=True)
+        for _ in range(count)
+    ]
+
+def allocate_input_buffers(count, batch_size, max_seq_len):
+    """Allocates pinned host buffers that padded model inputs are staged in before upload."""
+    return [
+        {
+            key: torch.empty((batch_size, max_seq_len), dtype=torch.long, pin_memory=True)
+            for key in ("input_ids", "attention_mask")
+        }
+        for _ in range(count)
+    ]
+
+def quantize_onnx_model(model_path):
+    """Writes (once) and returns a dynamically INT8-quantized copy of an ONNX model."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    cache_dir = os.path.join(script_dir, ONNX_CACHE_DIR)
+    quantized_path = os.path.join(cache_dir, "model_int8.onnx")
+    if not os.path.exists(quantized_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        logging.info(f"Quantizing {model_path} to INT8 at {quantized_path}")
+        quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+    return quantized_path
+
+def load_onnx_session():
+    """Downloads the exported MiniLM ONNX model and opens a session on the best provider."""
+    # Only needed by the ONNX backend, so the default PyTorch path runs without them.
+    import onnxruntime as ort
+    from huggingface_hub import snapshot_download
+
+    available_providers = ort.get_available_providers()
+    logging.info(f"ONNX Runtime Available Providers: {available_providers}")
+    if "TensorrtExecutionProvider" in available_providers:
+        providers = [
+            ("TensorrtExecutionProvider", {"trt_fp16_enable": True, "trt_engine_cache_enable": True}),
+            "CUDAExecutionProvider",
+            "CPUExecutionProvider",
+        ]
+    elif "CUDAExecutionProvider" in available_providers:
+        providers = ["CUDAExecutionProvider", "CPUExecutionProvider"]
+    elif "OpenVINOExecutionProvider" in available_providers:
+        # onnxruntime-openvino fuses the encoder into OpenVINO's CPU kernels.
+        providers = ["OpenVINOExecutionProvider", "CPUExecutionProvider"]
+    else:
+        providers = ["CPUExecutionProvider"]
+
+    model_dir = snapshot_download(MODEL_ONNX_REPO)
+    model_path = os.path.join(model_dir, "model.onnx")
+    if not os.path.exists(model_path):
+        onnx_files = [f for f in os.listdir(model_dir) if f.endswith(".onnx")]
+        if not onnx_files:
+            raise FileNotFoundError(f"No ONNX file found in {model_dir} for {MODEL_ONNX_REPO}")
+        model_path = os.path.join(model_dir, onnx_files[0])
+
+    if ONNX_QUANTIZE_INT8:
+        model_path = quantize_onnx_model(model_path)
+        if providers[0] != "CPUExecutionProvider":
+            logging.warning(
+                "INT8 dynamic quantization targets the default CPU provider; other providers may fall back to it."
+            )
+
+    logging.info(f"Loading ONNX model from: {model_path}")
+    session = ort.InferenceSession(model_path, providers=providers)
+    return session, session.get_providers()[0]
+
+def load_encoder_model(**kwargs):
+    """Loads the transformer with PyTorch's fused SDPA attention when transformers supports it for the model."""
     try:
-        token_id_lists = [item[2] for item in batch_data]
-        batch_dicts = [{"input_ids": ids} for ids in token_id_lists]
-
-        data_collator = DataCollatorWithPadding(
-            tokenizer=tokenizer,
-            padding='max_length',
-            max_length=max_seq_len,
-            return_tensors="pt"
-        )
-        inputs = data_collator(batch_dicts)
-        inputs = {k: v.to(device) for k, v in inputs.items()}
+        return AutoModel.from_pretrained(MODEL_NAME, attn_implementation="sdpa", **kwargs)
+    except (ValueError, TypeError, ImportError) as e:
+        logging.warning(f"SDPA attention unavailable ({e}). Falling back to eager attention.")
+        return AutoModel.from_pretrained(MODEL_NAME, **kwargs)
+
+class MeanPoolingEncoder(torch.nn.Module):
+    """Wraps a transformer so one forward call returns pooled (and normalized) embeddings.
+
+    Keeping pooling inside the module lets torch.compile fuse it with the encoder and
+    capture the whole step in a single CUDA graph.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, **kwargs):
+        hidden = self.model(input_ids=input_ids, attention_mask=attention_mask, **kwargs).last_hidden_state
+        # Mean-pool over real tokens only; padded positions are masked out.
+        mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+        # Accumulate in FP32 so half-precision hidden states don't lose the average.
+        summed = (hidden * mask).sum(dim=1, dtype=torch.float32)
+        embeddings = summed / mask.sum(dim=1, dtype=torch.float32).clamp(min=1)
+        if NORMALIZE_EMBEDDINGS:
+            embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
+        return embeddings
+
+def build_model_inputs(tokenizer, batch_data, max_seq_len, return_tensors):
+    """Wraps each chunk's token IDs with [CLS]/[SEP] and pads the batch to its longest chunk."""
+    # Chunks arrive as raw token IDs; add special tokens here instead of
+    # decoding and re-tokenizing.
+    max_content_tokens = max_seq_len - tokenizer.num_special_tokens_to_add(pair=False)
+    token_id_lists = [
+        tokenizer.build_inputs_with_special_tokens(item[2][:max_content_tokens])
+        for item in batch_data
+    ]
+    return tokenizer.pad(
+        {"input_ids": token_id_lists},
+        padding=True,
+        pad_to_multiple_of=LENGTH_BUCKET_WIDTH if TORCH_COMPILE else None,
+        return_tensors=return_tensors,
+    )
+
+def encode_batch(model, tokenizer, batch_data, device, max_seq_len, out_buffer=None, in_buffer=None):
+    """Dispatches a batch to the PyTorch or ONNX Runtime encoder."""
+    if EMBEDDING_BACKEND == "onnx":
+        return encode_batch_onnx(model, tokenizer, batch_data, max_seq_len)
+    return encode_batch_token_ids(
+        model, tokenizer, batch_data, device, max_seq_len, out_buffer, in_buffer
+    )
+
+def encode_batch_token_ids(model, tokenizer, batch_data, device, max_seq_len, out_buffer=None, in_buffer=None):
+    """Encodes a batch of token ID lists with forced truncation.
+
+    With an `in_buffer`, inputs are staged in pinned memory and uploaded without
+    blocking. With an `out_buffer`, the pooled FP32 embeddings are copied (and cast to
+    the buffer's dtype) into the pinned buffer without blocking; the returned event
+    must be waited on (see `collect_embeddings`) before either buffer is reused.
+    """
+    try:
+        inputs = build_model_inputs(tokenizer, batch_data, max_seq_len, "pt")
+        for key, value in inputs.items():
+            if in_buffer is not None and key in in_buffer:
+                # A contiguous view of the slot's leading elements: slicing the 2-D
+                # buffer to a shorter sequence length would not be contiguous, and
+                # .to() would then upload a pageable copy synchronously.
+                staged = in_buffer[key].view(-1)[: value.numel()].view_as(value)
+                staged.copy_(value)
+                inputs[key] = staged.to(device, non_blocking=True)
+            else:
+                inputs[key] = value.to(device)
         logging.debug(f"Padded/Truncated batch shape: {inputs['input_ids'].shape}")
 
-        with torch.no_grad():
-            outputs = model(**inputs)
+        with torch.inference_mode():
+            if USE_CUDA_GRAPHS:
+                # The previous replay's output has been copied out by now; let the
+                # graph reuse its memory.
+                torch.compiler.cudagraph_mark_step_begin()
+            embeddings = model(**inputs)
+
+        if out_buffer is None:
+            return embeddings.cpu().numpy(), None
 
-        embeddings = outputs.last_hidden_state.mean(dim=1)
-        return embeddings.cpu().numpy()
+        host_embeddings = out_buffer[: len(batch_data)]
+        host_embeddings.copy_(embeddings, non_blocking=True)
+        copy_done = torch.cuda.Event()
+        copy_done.record()
+        return host_embeddings, copy_done
     except Exception as e:
         logging.error(f"Error in encode_batch_token_ids: {e}", exc_info=True)
         raise
 
+def encode_batch_onnx(session, tokenizer, batch_data, max_seq_len):
+    """Encodes a batch of token ID lists with an ONNX Runtime session."""
+    try:
+        inputs = build_model_inputs(tokenizer, batch_data, max_seq_len, "np")
+        input_names = {inp.name for inp in session.get_inputs()}
+        ort_inputs = {
+            key: np.asarray(value, dtype=np.int64)
+            for key, value in inputs.items()
+            if key in input_names
+        }
+        if "token_type_ids" in input_names and "token_type_ids" not in ort_inputs:
+            ort_inputs["token_type_ids"] = np.zeros_like(ort_inputs["input_ids"])
+
+        embeddings = session.run(None, ort_inputs)[0]
+        if embeddings.ndim == 3:
+            mask = np.expand_dims(ort_inputs["attention_mask"], axis=-1).astype(embeddings.dtype)
+            embeddings = (embeddings * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1)
+        embeddings = embeddings.astype(np.float32, copy=False)
+        if NORMALIZE_EMBEDDINGS:
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings = embeddings / np.maximum(norms, 1e-12)
+        return embeddings, None
+    except Exception as e:
+        logging.error(f"Error in encode_batch_onnx: {e}", exc_info=True)
+        raise
+
+def probe_max_batch_size(model, tokenizer, device, max_seq_len, candidates):
+    """Returns a batch size with headroom: the candidate below the largest that fits at max_seq_len.
+
+    The largest size that just fits leaves nothing for compiled graphs, CUDA-graph
+    pools or allocator fragmentation later on, and an OOM mid-run is fatal.
+    """
+    content_tokens = max_seq_len - tokenizer.num_special_tokens_to_add(pair=False)
+    dummy_chunk = ("", 0, [tokenizer.unk_token_id] * content_tokens)
+    fitted = []
+    for batch_size in sorted(candidates):
+        try:
+            inputs = build_model_inputs(tokenizer, [dummy_chunk] * batch_size, max_seq_len, "pt")
+            inputs = {k: v.to(device) for k, v in inputs.items()}
+            with torch.inference_mode():
+                model(**inputs)
+            torch.cuda.synchronize()
+            fitted.append(batch_size)
+        except torch.cuda.OutOfMemoryError:
+            break
+        finally:
+            inputs = None
+            torch.cuda.empty_cache()
+    if not fitted:
+        return None
+    return fitted[-2] if len(fitted) > 1 else fitted[0]
+
+def warm_up_compiled_model(model, tokenizer, device, max_seq_len, batch_size):
+    """Runs one full-size dummy batch per padded length so compilation happens up front."""
+    num_special = tokenizer.num_special_tokens_to_add(pair=False)
+    for padded_len in range(LENGTH_BUCKET_WIDTH, max_seq_len + 1, LENGTH_BUCKET_WIDTH):
+        dummy_chunk = ("", 0, [tokenizer.unk_token_id] * (padded_len - num_special))
+        inputs = build_model_inputs(tokenizer, [dummy_chunk] * batch_size, max_seq_len, "pt")
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+        # CUDA graphs are only recorded after a warm-up run of each shape.
+        for _ in range(3 if USE_CUDA_GRAPHS else 1):
+            with torch.inference_mode():
+                if USE_CUDA_GRAPHS:
+                    torch.compiler.cudagraph_mark_step_begin()
+                model(**inputs)
+
+def collect_embeddings(pending):
+    """Waits for an in-flight encode and returns its embeddings as an owned NumPy array."""
+    embeddings, copy_done = pending
+    if copy_done is None:
+        return embeddings
+    copy_done.synchronize()
+    # The pinned buffer is reused by a later batch, so detach the data from it.
+    return embeddings.numpy().copy()
+
 if __name__ == "__main__":
     logging.info("--- Starting Embedding Generation from Filesystem ---")
     overall_start_time = time.time()
@@ -235,46 +1085,83 @@ if __name__ == "__main__":
     try:
         tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, use_fast=True)
 
-        if torch.cuda.is_available():
-            gpu_name = torch.cuda.get_device_name(0)
-            logging.info(f"GPU detected: {gpu_name}. Attempting to load model in 8-bit.")
-            try:
-                # Requires bitsandbytes and accelerate libraries
-                model = AutoModel.from_pretrained(
-                    MODEL_NAME,
-                    load_in_8bit=True,
-                )
-                # Check where the model was actually placed
-                device = str(next(model.parameters()).device)
-                model_precision = "INT8"
-                logging.info(f"Successfully loaded model in 8-bit on {device}.")
+        if EMBEDDING_BACKEND == "onnx":
+            model, device = load_onnx_session()
+            model_precision = "ONNX INT8" if ONNX_QUANTIZE_INT8 else "ONNX"
+            from transformers import AutoConfig
 
-            except ImportError:
-                logging.warning(
-                    "bitsandbytes or accelerate not installed. Falling back to default precision (FP32) on GPU."
-                )
+            embedding_dim = AutoConfig.from_pretrained(MODEL_NAME).hidden_size
+        else:
+            if torch.cuda.is_available():
+                torch.backends.cuda.matmul.allow_tf32 = True
+                gpu_name = torch.cuda.get_device_name(0)
+                # MiniLM is small enough that 8-bit dequantization costs more than it
+                # saves; half precision keeps the fused cuBLAS paths.
+                if torch.cuda.is_bf16_supported():
+                    model_dtype, model_precision = torch.bfloat16, "BF16"
+                else:
+                    model_dtype, model_precision = torch.float16, "FP16"
+                logging.info(f"GPU detected: {gpu_name}. Loading model in {model_precision}.")
                 device = "cuda"
-                model = AutoModel.from_pretrained(MODEL_NAME)
+                model = load_encoder_model(torch_dtype=model_dtype)
                 model.to(device)
-                model_precision = "FP32"
-            except Exception as e:
+            else:
                 logging.warning(
-                    f"Failed to load model in 8-bit: {e}. Falling back to default precision (FP32) on GPU."
+                    "CUDA not available. Using CPU with default precision (FP32)."
                 )
-                device = "cuda"
-                model = AutoModel.from_pretrained(MODEL_NAME)
-                model.to(device)
-                model_precision = "FP32"
-        else:
-            logging.warning(
-                "CUDA not available. Using CPU with default precision (FP32)."
+                device = "cpu"
+                model = load_encoder_model()
+                model_dtype, model_precision = torch.float32, "FP32"
+                if TORCH_CPU_QUANTIZE_INT8:
+                    # Linear layers dominate MiniLM's CPU time; INT8 weights use the
+                    # VNNI/AVX2 integer GEMM kernels.
+                    model = torch.ao.quantization.quantize_dynamic(
+                        model, {torch.nn.Linear}, dtype=torch.qint8
+                    )
+                    model_precision = "INT8 (dynamic)"
+
+            model.eval()  # Set model to evaluation mode
+            embedding_dim = model.config.hidden_size
+            model = MeanPoolingEncoder(model).eval()
+
+        chunk_window = compute_chunk_window(tokenizer, MAX_SEQ_LENGTH, CHUNK_OVERLAP)
+        if chunk_window is None:
+            raise ValueError(f"MAX_SEQ_LENGTH {MAX_SEQ_LENGTH} leaves no room for content tokens.")
+        # Before compilation: compiling reorders arithmetic but keeps the precision.
+        content_hash_seed = compute_content_hash_seed(model_precision)
+
+        if AUTO_BATCH_SIZE and EMBEDDING_BACKEND == "torch" and device.startswith("cuda"):
+            logging.info("Probing GPU batch size...")
+            probed_batch_size = probe_max_batch_size(
+                model, tokenizer, device, MAX_SEQ_LENGTH, AUTO_BATCH_SIZE_CANDIDATES
             )
-            device = "cpu"
-            model = AutoModel.from_pretrained(MODEL_NAME)
-            model_precision = "FP32"
+            if probed_batch_size is None:
+                logging.warning(f"No probed batch size fit in GPU memory. Keeping {CHUNK_BATCH_SIZE}.")
+            else:
+                CHUNK_BATCH_SIZE = probed_batch_size
+                CHUNK_QUEUE_SIZE = CHUNK_BATCH_SIZE * 8
+                logging.info(f"Using batch size {CHUNK_BATCH_SIZE}.")
+
+        if TORCH_COMPILE and EMBEDDING_BACKEND == "torch":
+            # Compiled after the batch size probe so the probe doesn't trigger compiles.
+            if TORCH_COMPILE_BACKEND == "tensorrt":
+                import torch_tensorrt  # noqa: F401 -- registers the "tensorrt" backend
+
+                # Same dtype the weights were loaded in, so the engine doesn't quietly
+                # run a BF16 model in FP16.
+                model = torch.compile(
+                    model,
+                    backend="tensorrt",
+                    dynamic=False,
+                    options={"enabled_precisions": {model_dtype}},
+                )
+                model_precision += " (compiled, TensorRT)"
+            else:
+                model = torch.compile(model, mode=TORCH_COMPILE_MODE, dynamic=False)
+                model_precision += f" (compiled, {TORCH_COMPILE_MODE})"
+            logging.info("Compiling model for each padded sequence length...")
+            warm_up_compiled_model(model, tokenizer, device, MAX_SEQ_LENGTH, CHUNK_BATCH_SIZE)
 
-        model.eval()  # Set model to evaluation mode
-        embedding_dim = model.config.hidden_size
         logging.info(f"Model ready. Precision: {model_precision}. Device: {device}. Embedding Dim: {embedding_dim}")
 
     except Exception as e:
@@ -282,8 +1169,32 @@ if __name__ == "__main__":
         sys.exit(1)
 
     conn = connect_db()
+    db_queue = queue.Queue(maxsize=DB_QUEUE_SIZE)
+    inserted_counts = []
+    db_threads = []
+    existing_hashes = None
     try:
         create_table_if_not_exists(conn, embedding_dim)
+        existing_hashes = (
+            fetch_content_hashes(conn)
+            if SKIP_UNCHANGED
+            else ContentHashIndex.create(np.empty(0, np.uint64), np.empty(0, np.int64))
+        )
+        if len(existing_hashes):
+            logging.info(f"Loaded content hashes for {len(existing_hashes)} completely embedded documents.")
+        logging.info(
+            f"Insert mode: {INSERT_MODE}. Async commit: {DB_ASYNC_COMMIT}. Writers: {DB_WRITER_COUNT}"
+        )
+
+        # Each writer thread owns a separate connection, so commits overlap with
+        # tokenization and encoding, and with each other, instead of stalling them.
+        writer_conns = [connect_writer_db() for _ in range(DB_WRITER_COUNT)]
+        for writer_conn in writer_conns:
+            db_thread = threading.Thread(
+                target=db_writer, args=(writer_conn, db_queue, inserted_counts), daemon=True
+            )
+            db_thread.start()
+            db_threads.append(db_thread)
 
         # Find all files (no longer limiting to one)
         all_files = glob.glob(os.path.abspath(os.path.join(script_dir, ANALYSES_DIR_PATTERN)))
@@ -291,130 +1202,194 @@ if __name__ == "__main__":
             logging.error("No files found.")
             sys.exit(1)
         total_files = len(all_files)
-        logging.info(f"Found {total_files} files to process.")
+        # File sizes are a stat() away and track tokenizer/model work closely enough
+        # for an ETA, without a separate pass over the data.
+        file_sizes = {f: os.path.getsize(f) for f in all_files}
+        total_bytes = sum(file_sizes.values())
+        logging.info(f"Found {total_files} files to process ({total_bytes / 1024**3:.2f} GiB).")
 
         # --- Start Processing (Parallel) ---
         process_start_time = time.time()
         chunks_processed_count = 0
         files_processed_count = 0
         db_batch = []
-        model_input_batch = []
+        db_embeddings = []
+        pending_batch, pending_duplicates, pending_embeddings = [], [], None
+        encoded_batch_count = 0
         last_eta_print_time = time.time()
 
-        pbar_total = max(1, total_files)
-        pbar_unit = "file"
-        pbar = tqdm(total=pbar_total, desc="Processing", unit=pbar_unit)
-
-        with ThreadPoolExecutor(max_workers=MAX_CPU_WORKERS) as executor:
-            submitted_futures = {
-                executor.submit(
-                    process_file_yield_token_ids_fs,
-                    f,
-                    tokenizer,
-                    MAX_SEQ_LENGTH,
-                    CHUNK_OVERLAP,
-                ): f
-                for f in all_files
-            }
-
-            for future in as_completed(submitted_futures):
-                file_path = submitted_futures[future]
+        if device.startswith("cuda"):
+            # halfvec columns only need FP16 on the host, so copy half the bytes back.
+            output_dtype = torch.float16 if EMBEDDING_DB_TYPE == "halfvec" else torch.float32
+            output_buffers = allocate_output_buffers(
+                OUTPUT_BUFFER_COUNT, CHUNK_BATCH_SIZE, embedding_dim, output_dtype
+            )
+            # Rotated in step with the output buffers: a slot is only refilled after
+            # collect_embeddings has waited on the batch that last used it.
+            input_buffers = allocate_input_buffers(
+                OUTPUT_BUFFER_COUNT, CHUNK_BATCH_SIZE, MAX_SEQ_LENGTH
+            )
+        else:
+            output_buffers = [None]
+            input_buffers = [None]
+
+        pbar_total = max(1, total_bytes)
+        pbar_unit = "B"
+        pbar = tqdm(
+            total=pbar_total,
+            desc="Processing",
+            unit=pbar_unit,
+            unit_scale=True,
+            mininterval=1.0,
+            smoothing=0,
+        )
+
+        if FILE_WORKER_MODE == "process":
+            # spawn: the parent has CUDA initialized, which forked children must not inherit.
+            mp_context = multiprocessing.get_context("spawn")
+            chunk_queue = mp_context.Queue(maxsize=CHUNK_QUEUE_SIZE)
+            stop_event = mp_context.Event()
+            executor = ProcessPoolExecutor(
+                max_workers=MAX_CPU_WORKERS,
+                mp_context=mp_context,
+                initializer=init_file_worker,
+                initargs=(chunk_window, content_hash_seed, existing_hashes, chunk_queue, stop_event),
+            )
+        else:
+            chunk_queue = queue.Queue(maxsize=CHUNK_QUEUE_SIZE)
+            stop_event = threading.Event()
+            executor = ThreadPoolExecutor(
+                max_workers=MAX_CPU_WORKERS, initializer=init_thread_tokenizer
+            )
+        try:
+            bytes_progress = defaultdict(int)
+            # Keep only a window of files submitted; each finished file admits the next.
+            pending_files = iter(all_files)
+
+            def submit_next_file():
+                next_file = next(pending_files, None)
+                if next_file is None:
+                    return
                 try:
-                    for url, chunk_id, token_ids in future.result():
-                        if len(token_ids) > MAX_SEQ_LENGTH * 1.1:
-                            logging.warning(f"Received abnormally long token list ({len(token_ids)} tokens) from chunker for {url} chunk {chunk_id}. Skipping.")
-                            continue
-
-                        model_input_batch.append((url, chunk_id, token_ids))
-
-                        if len(model_input_batch) >= CHUNK_BATCH_SIZE:
-                            batch_to_encode = model_input_batch[:CHUNK_BATCH_SIZE]
-                            model_input_batch = model_input_batch[CHUNK_BATCH_SIZE:]
-
-                            try:
-                                embeddings = encode_batch_token_ids(
-                                    model, tokenizer, batch_to_encode, device, MAX_SEQ_LENGTH
-                                )
-
-                                for j, (url_b, chunk_id_b, _) in enumerate(batch_to_encode):
-                                    db_batch.append((url_b, chunk_id_b, embeddings[j].tolist()))
-                                chunks_processed_count += len(batch_to_encode)
-
-                            except Exception as model_err:
-                                logging.error(f"Fatal model error: {model_err}", exc_info=True)
-                                sys.exit(1)
-
-                            if len(db_batch) >= DB_BATCH_SIZE:
-                                try:
-                                    with conn.cursor() as cur:
-                                        psycopg2.extras.execute_values(
-                                            cur,
-                                            f"""
-                                            INSERT INTO {DB_TABLE_NAME} (url, chunk_id, embedding)
-                                            VALUES %s
-                                            ON CONFLICT (url, chunk_id) DO UPDATE SET embedding = EXCLUDED.embedding;
-                                            """,
-                                            db_batch,
-                                            template="(%s, %s, %s::vector)",
-                                            page_size=len(db_batch),
-                                        )
-                                    conn.commit()
-                                    db_batch = []
-                                except psycopg2.Error as db_err:
-                                    logging.error(f"Database batch insert failed: {db_err}")
-                                    conn.rollback()
-                                    db_batch = []
-                                except Exception as general_db_err:
-                                    logging.error(f"Unexpected error during DB insert: {general_db_err}", exc_info=True)
-                                    conn.rollback()
-                                    db_batch = []
+                    if FILE_WORKER_MODE == "process":
+                        future = executor.submit(produce_file_token_ids_in_process, next_file)
+                    else:
+                        future = executor.submit(
+                            produce_file_token_ids_in_thread,
+                            next_file,
+                            chunk_window,
+                            content_hash_seed,
+                            existing_hashes,
+                            chunk_queue,
+                            stop_event,
+                        )
+                except BrokenExecutor as e:
+                    logging.error(f"File worker pool is broken: {e}. Exiting.")
+                    sys.exit(1)
+                future.add_done_callback(
+                    partial(report_file_worker_failure, next_file, chunk_queue, stop_event)
+                )
 
+            # Initializers only run once a worker starts; check one up front so a
+            # tokenizer that fails to load stops the run before any file is queued.
+            try:
+                executor.submit(file_worker_ready).result()
+            except BrokenExecutor as e:
+                logging.error(f"File workers failed to initialize: {e}. Exiting.")
+                sys.exit(1)
+
+            for _ in range(MAX_CPU_WORKERS * 2):
+                submit_next_file()
+
+            for marker, payload in iter_length_bucketed_batches(
+                chunk_queue, total_files, CHUNK_BATCH_SIZE, MAX_SEQ_LENGTH
+            ):
+                if marker == BYTES_READ:
+                    progress_file, nbytes = payload
+                    bytes_progress[progress_file] += nbytes
+                    pbar.update(nbytes)
+                    continue
+                if marker == FILE_FAILED:
+                    logging.error(f"File worker pool broke while processing {payload}. Exiting.")
+                    sys.exit(1)
+                if marker == FILE_DONE:
+                    submit_next_file()
+                    # Files that failed part-way never report their tail; account for it here.
                     files_processed_count += 1
-                    pbar.update(1)
+                    pbar.update(max(0, file_sizes[payload] - bytes_progress.pop(payload, 0)))
+                    now = time.time()
+                    if now - last_eta_print_time >= ETA_UPDATE_INTERVAL_SEC or files_processed_count == total_files:
+                        last_eta_print_time = now
+                        # refresh=False: let tqdm's own mininterval decide when to redraw.
+                        pbar.set_postfix(
+                            files=f"{files_processed_count}/{total_files}",
+                            chunks=chunks_processed_count,
+                            refresh=False,
+                        )
+                    continue
+
+                batch_data, duplicates = payload
+                try:
+                    buffer_slot = encoded_batch_count % len(output_buffers)
+                    pending = encode_batch(
+                        model,
+                        tokenizer,
+                        batch_data,
+                        device,
+                        MAX_SEQ_LENGTH,
+                        output_buffers[buffer_slot],
+                        input_buffers[buffer_slot],
+                    )
+                    encoded_batch_count += 1
 
-                except Exception as e:
-                    logging.error(f"Error processing file {file_path}: {e}", exc_info=True)
+                    # Collect the previous batch while the GPU works on this one.
+                    if pending_batch:
+                        rows, embeddings = expand_duplicate_chunks(
+                            pending_batch, pending_duplicates, collect_embeddings(pending_embeddings)
+                        )
+                        db_batch.extend(rows)
+                        db_embeddings.append(embeddings)
+                        chunks_processed_count += len(rows)
+                    pending_batch, pending_duplicates, pending_embeddings = batch_data, duplicates, pending
 
-        if model_input_batch:
-            batch_to_encode = model_input_batch
+                except Exception as model_err:
+                    logging.error(f"Fatal model error: {model_err}", exc_info=True)
+                    sys.exit(1)
+
+                if len(db_batch) >= DB_BATCH_SIZE:
+                    db_queue.put((db_batch, np.concatenate(db_embeddings)))
+                    db_batch = []
+                    db_embeddings = []
+        finally:
+            # Unblock any producer waiting on a full queue before joining the pool.
+            stop_event.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        if pending_batch:
             try:
-                embeddings = encode_batch_token_ids(
-                    model, tokenizer, batch_to_encode, device, MAX_SEQ_LENGTH
+                rows, embeddings = expand_duplicate_chunks(
+                    pending_batch, pending_duplicates, collect_embeddings(pending_embeddings)
                 )
-
-                for j, (url_b, chunk_id_b, _) in enumerate(batch_to_encode):
-                    db_batch.append((url_b, chunk_id_b, embeddings[j].tolist()))
-                chunks_processed_count += len(batch_to_encode)
+                db_batch.extend(rows)
+                db_embeddings.append(embeddings)
+                chunks_processed_count += len(rows)
+                pending_batch, pending_duplicates, pending_embeddings = [], [], None
             except Exception as model_err:
                 logging.error(f"Fatal model error: {model_err}", exc_info=True)
                 sys.exit(1)
 
         if db_batch:
-            try:
-                with conn.cursor() as cur:
-                    psycopg2.extras.execute_values(
-                        cur,
-                        f"""
-                        INSERT INTO {DB_TABLE_NAME} (url, chunk_id, embedding)
-                        VALUES %s
-                        ON CONFLICT (url, chunk_id) DO UPDATE SET embedding = EXCLUDED.embedding;
-                        """,
-                        db_batch,
-                        template="(%s, %s, %s::vector)",
-                        page_size=len(db_batch),
-                    )
-                conn.commit()
-                db_batch = []
-            except psycopg2.Error as db_err:
-                logging.error(f"Database batch insert failed: {db_err}")
-                conn.rollback()
-                db_batch = []
-            except Exception as general_db_err:
-                logging.error(f"Unexpected error during DB insert: {general_db_err}", exc_info=True)
-                conn.rollback()
-                db_batch = []
+            db_queue.put((db_batch, np.concatenate(db_embeddings)))
+            db_batch = []
+            db_embeddings = []
 
     finally:
+        for _ in db_threads:
+            db_queue.put(None)
+        for db_thread in db_threads:
+            db_thread.join()
+        if existing_hashes is not None:
+            existing_hashes.release(unlink=True)
         if conn:
             conn.close()
             logging.info("Database connection closed.")
@@ -429,4 +1404,5 @@ if __name__ == "__main__":
     )
     logging.info(f"Model Precision Used: {model_precision}")
     logging.info(f"Total Chunks Embedded: {chunks_processed_count}")
+    logging.info(f"Total Rows Inserted: {sum(inserted_counts)}")
     logging.info(f"Total Files Processed: {files_processed_count}/{total_files}")
\ No newline at end of file
@@ -1,4 +1,4 @@
-import time, os, psycopg2, psycopg2.extras, numpy as np
+import time, os, io, struct, psycopg2, numpy as np
 from pgvector.psycopg2 import register_vector
 from tqdm import tqdm
 import logging
@@ -21,6 +21,7 @@ except Exception as e:
 
 SOURCE_TABLE_NAME = "document_chunk_embeddings"
 TARGET_TABLE_NAME = "document_embeddings"
+STAGING_TABLE_NAME = "staging_document_embeddings"
 URL_FETCH_BATCH_SIZE = 1000
 DB_INSERT_BATCH_SIZE = 5000
 
@@ -29,6 +30,11 @@ if not PRIVATE_DB_URL:
     logging.error("DB URL not set")
     sys.exit(1)
 
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+PGCOPY_TRAILER = struct.pack(">h", -1)
+# Big-endian element type of each pgvector type's binary representation
+VECTOR_ELEMENT_DTYPES = {"vector": ">f4", "halfvec": ">f2"}
+
 
 def connect_db():
     try:
@@ -44,7 +50,7 @@ def connect_db():
 
 def get_embedding_dimension(conn):
     with conn.cursor() as cur:
-        cur.execute(f"SELECT embedding FROM {SOURCE_TABLE_NAME} LIMIT 1;")
+        cur.execute(f"SELECT embedding::vector FROM {SOURCE_TABLE_NAME} LIMIT 1;")
         result = cur.fetchone()
         if result and result[0] is not None:
             return len(result[0])
@@ -52,7 +58,23 @@ def get_embedding_dimension(conn):
         return None
 
 
-def create_merged_table_if_not_exists(conn, embedding_dim):
+def get_embedding_type(conn):
+    # Chunk embeddings may be stored as vector or halfvec; the merged table matches.
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT t.typname
+            FROM pg_attribute a
+            JOIN pg_type t ON t.oid = a.atttypid
+            WHERE a.attrelid = %s::regclass AND a.attname = 'embedding';
+            """,
+            (SOURCE_TABLE_NAME,),
+        )
+        result = cur.fetchone()
+        return result[0] if result else "vector"
+
+
+def create_merged_table_if_not_exists(conn, embedding_dim, embedding_type):
     if embedding_dim is None:
         logging.error("No embedding dimension.")
         return False
@@ -62,20 +84,55 @@ def create_merged_table_if_not_exists(conn, embedding_dim):
             f"""
             CREATE TABLE IF NOT EXISTS {TARGET_TABLE_NAME} (
                 url TEXT PRIMARY KEY,
-                embedding VECTOR({embedding_dim})
+                embedding {embedding_type.upper()}({embedding_dim})
             );
         """
         )
         cur.execute(
             f"""
             CREATE INDEX IF NOT EXISTS idx_{TARGET_TABLE_NAME}_embedding
-            ON {TARGET_TABLE_NAME} USING hnsw (embedding vector_l2_ops);
+            ON {TARGET_TABLE_NAME} USING hnsw (embedding {embedding_type}_l2_ops);
         """
         )
         conn.commit()
     return True
 
 
+def create_staging_table(conn):
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE_NAME}
+            (LIKE {TARGET_TABLE_NAME} INCLUDING DEFAULTS)
+            ON COMMIT DELETE ROWS;
+        """
+        )
+    conn.commit()
+
+
+def build_copy_buffer(data_batch, embedding_type):
+    # Binary COPY rows: field count, url, then pgvector's uint16 dim, uint16 unused
+    # and big-endian elements.
+    element_dtype = np.dtype(VECTOR_ELEMENT_DTYPES[embedding_type])
+    # Convert the whole batch once and slice rows out of one contiguous buffer.
+    embeddings = np.stack([emb for _, emb in data_batch]).astype(element_dtype)
+    dim = embeddings.shape[1]
+    vector_bytes = dim * element_dtype.itemsize
+    vector_field_header = struct.pack(">iHH", 4 + vector_bytes, dim, 0)
+    slab = memoryview(embeddings.tobytes())
+    buf = io.BytesIO()
+    buf.write(PGCOPY_HEADER)
+    for i, (url, _) in enumerate(data_batch):
+        url_bytes = url.encode("utf-8")
+        buf.write(struct.pack(">hi", 2, len(url_bytes)))
+        buf.write(url_bytes)
+        buf.write(vector_field_header)
+        buf.write(slab[i * vector_bytes : (i + 1) * vector_bytes])
+    buf.write(PGCOPY_TRAILER)
+    buf.seek(0)
+    return buf
+
+
 def fetch_distinct_urls(conn):
     with conn.cursor() as cur:
         cur.execute(
@@ -93,34 +150,35 @@ def process_url_batch(conn, urls_batch):
     merged = {}
     if not urls_batch:
         return merged
-    query = f"SELECT url, embedding FROM {SOURCE_TABLE_NAME} WHERE url = ANY(%s);"
+    # Cast to vector so halfvec rows are averaged in FP32.
+    query = f"SELECT url, embedding::vector FROM {SOURCE_TABLE_NAME} WHERE url = ANY(%s);"
     groups = {}
     with conn.cursor() as cur:
         cur.execute(query, (urls_batch,))
         for url, emb in cur.fetchall():
             if emb is not None:
-                groups.setdefault(url, []).append(np.array(emb))
+                # register_vector already hands back float32 ndarrays
+                groups.setdefault(url, []).append(emb)
     for url, arr in groups.items():
-        merged[url] = np.mean(np.stack(arr), axis=0).tolist()
+        merged[url] = np.mean(np.stack(arr), axis=0, dtype=np.float32)
     return merged
 
 
-def insert_merged_embeddings(conn, data_batch):
+def insert_merged_embeddings(conn, data_batch, embedding_type):
     if not data_batch:
         return 0
-    query = f"""
-        INSERT INTO {TARGET_TABLE_NAME} (url, embedding)
-        VALUES %s
-        ON CONFLICT (url) DO UPDATE SET embedding = EXCLUDED.embedding;
-    """
     try:
         with conn.cursor() as cur:
-            psycopg2.extras.execute_values(
-                cur,
-                query,
-                data_batch,
-                template="(%s, %s::vector)",
-                page_size=len(data_batch),
+            cur.copy_expert(
+                f"COPY {STAGING_TABLE_NAME} (url, embedding) FROM STDIN WITH (FORMAT BINARY)",
+                build_copy_buffer(data_batch, embedding_type),
+            )
+            cur.execute(
+                f"""
+                INSERT INTO {TARGET_TABLE_NAME} (url, embedding)
+                SELECT url, embedding FROM {STAGING_TABLE_NAME}
+                ON CONFLICT (url) DO UPDATE SET embedding = EXCLUDED.embedding;
+            """
             )
         conn.commit()
         return len(data_batch)
@@ -134,10 +192,12 @@ if __name__ == "__main__":
     overall_start = time.time()
     conn = connect_db()
     embedding_dim = get_embedding_dimension(conn)
+    embedding_type = get_embedding_type(conn)
     if embedding_dim is None or not create_merged_table_if_not_exists(
-        conn, embedding_dim
+        conn, embedding_dim, embedding_type
     ):
         sys.exit(1)
+    create_staging_table(conn)
     urls = fetch_distinct_urls(conn)
     if not urls:
         sys.exit(0)
@@ -151,11 +211,11 @@ if __name__ == "__main__":
         for url, emb in merged_results.items():
             batch_data.append((url, emb))
         if len(batch_data) >= DB_INSERT_BATCH_SIZE:
-            processed += insert_merged_embeddings(conn, batch_data)
+            processed += insert_merged_embeddings(conn, batch_data, embedding_type)
             batch_data = []
         pbar.update(len(batch_urls))
     if batch_data:
-        processed += insert_merged_embeddings(conn, batch_data)
+        processed += insert_merged_embeddings(conn, batch_data, embedding_type)
     pbar.close()
     conn.close()
     logging.info(
@@ -107,7 +107,6 @@ def get_query_embedding(query_text, model, tokenizer, device, max_seq_len):
             query_text,
             return_tensors="pt",
             truncation=True,
-            padding="max_length",
             max_length=max_seq_len,
         )
         inputs = {k: v.to(device) for k, v in inputs.items()}
@@ -115,7 +114,10 @@ def get_query_embedding(query_text, model, tokenizer, device, max_seq_len):
         with torch.no_grad():
             outputs = model(**inputs)
 
-        embedding = outputs.last_hidden_state.mean(dim=1)
+        # Same masked mean pooling as generate_embeddings.py
+        hidden = outputs.last_hidden_state
+        mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+        embedding = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
         return embedding.cpu().numpy()[0]
     except Exception as e:
         logging.error(f"Error generating query embedding: {e}", exc_info=True)